@@ -1,24 +1,63 @@
 # app.py
+# Patch the standard library before anything opens a socket, so Firebase and
+# OpenAI I/O yields to other greenlets under the gevent Gunicorn worker.
+from gevent import monkey
+monkey.patch_all()
+
+# Firestore talks gRPC, whose C core would otherwise block the whole worker;
+# this makes its calls cooperative. Must run before any channel is created.
+import grpc.experimental.gevent as grpc_gevent
+grpc_gevent.init_gevent()
+
+import multiprocessing
 import os
 import firebase_admin
-import json
-from flask import Flask, request, jsonify
+import gevent
+import hashlib
+import hmac
+import httpx
+import jwt
+import orjson
+import atexit
+import threading
+import time
+from cachetools import TTLCache
+from collections import Counter, OrderedDict
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from firebase_admin import credentials, firestore
-from openai import OpenAI
+from google.api_core.exceptions import NotFound
+from openai import OpenAI, RateLimitError
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # --- INITIALIZATION ---
 
+class ORJSONProvider(JSONProvider):
+    """Serves request.json and jsonify() with orjson instead of the stdlib."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # Initialize Firebase
 try:
     firebase_credentials_json = os.environ.get("FIREBASE_CREDENTIALS")
     if not firebase_credentials_json:
         raise ValueError("FIREBASE_CREDENTIALS environment variable not set")
-    cred = credentials.Certificate(json.loads(firebase_credentials_json))
+    cred = credentials.Certificate(orjson.loads(firebase_credentials_json))
     firebase_admin.initialize_app(cred)
+    # A single client per worker; its gRPC channel multiplexes all requests.
     db = firestore.client()
     users_ref = db.collection('users')
     print("Firebase initialized successfully.")
@@ -27,17 +66,100 @@ except Exception as e:
     db = None
     users_ref = None
 
+# Open the gRPC channel now so the first request doesn't pay for the
+# handshake. Reading a (normally missing) placeholder document keeps this
+# cheap, and a failure here only costs the first request some latency.
+if db:
+    try:
+        users_ref.document('_warmup').get()
+    except Exception as e:
+        print(f"Warning: Firestore warm-up failed: {e}")
+
+# Caps on outgoing OpenAI traffic, so bursts queue locally instead of being
+# sent only to be rejected with a 429. The env vars are account-wide budgets;
+# each Gunicorn worker enforces its share, using the same worker count as
+# gunicorn.conf.py.
+GUNICORN_WORKERS = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", 50))
+OPENAI_MAX_REQUESTS_PER_MINUTE = int(os.environ.get("OPENAI_MAX_REQUESTS_PER_MINUTE", 500))
+OPENAI_WORKER_MAX_CONCURRENCY = max(1, OPENAI_MAX_CONCURRENCY // GUNICORN_WORKERS)
+OPENAI_WORKER_MAX_REQUESTS_PER_MINUTE = max(1, OPENAI_MAX_REQUESTS_PER_MINUTE // GUNICORN_WORKERS)
+
 # Initialize OpenAI Client
 try:
     openai_api_key = os.environ.get("OPENAI_API_KEY")
     if not openai_api_key:
         raise ValueError("OPENAI_API_KEY environment variable not set")
-    client = OpenAI(api_key=openai_api_key)
+    # One client per worker, shared by all greenlets. The pool matches the
+    # worker's OpenAI concurrency cap, and HTTP/2 multiplexes requests over a
+    # few long-lived TLS connections to api.openai.com.
+    openai_timeout = httpx.Timeout(60.0, connect=5.0)
+    openai_http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=OPENAI_WORKER_MAX_CONCURRENCY,
+            max_keepalive_connections=OPENAI_WORKER_MAX_CONCURRENCY,
+            keepalive_expiry=60
+        ),
+        timeout=openai_timeout,
+        http2=True
+    )
+    client = OpenAI(api_key=openai_api_key, http_client=openai_http_client, timeout=openai_timeout)
     print("OpenAI client initialized successfully.")
 except Exception as e:
     print(f"FATAL: Error initializing OpenAI client: {e}")
     client = None
 
+
+
+class RateLimiter:
+    """Token bucket that blocks callers until another request may be sent."""
+
+    def __init__(self, rate, period):
+        self.capacity = rate
+        self.fill_rate = rate / period
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+            gevent.sleep(wait)
+
+
+_openai_semaphore = threading.BoundedSemaphore(OPENAI_WORKER_MAX_CONCURRENCY)
+_openai_rate_limiter = RateLimiter(OPENAI_WORKER_MAX_REQUESTS_PER_MINUTE, 60)
+
+
+def create_chat_completion(**kwargs):
+    """Sends a chat completion request within the configured OpenAI limits."""
+    _openai_rate_limiter.acquire()
+    with _openai_semaphore:
+        return client.chat.completions.create(**kwargs)
+
+
+def stream_chat_completion(**kwargs):
+    """Yields the text deltas of a streamed chat completion within the limits.
+
+    The concurrency slot is held until the stream has been fully read. The
+    HTTP response is closed even if the caller stops early (e.g. the client
+    disconnected).
+    """
+    _openai_rate_limiter.acquire()
+    with _openai_semaphore:
+        with client.chat.completions.create(stream=True, **kwargs) as stream:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+
 # Subscription Tiers Configuration
 TIER_LIMITS = {
     'free': 5, # Added a free tier for new signups
@@ -46,6 +168,361 @@ TIER_LIMITS = {
     'tier3': 100,
     'enterprise': float('inf') # Effectively unlimited
 }
+# Tiers resolved to an index once, when a user enters the quota cache, so the
+# per-request limit check is a tuple lookup. The last slot is for unknown tiers.
+TIER_IDS = {tier: tier_id for tier_id, tier in enumerate(TIER_LIMITS)}
+TIER_LIMITS_BY_ID = tuple(TIER_LIMITS.values()) + (0,)
+UNKNOWN_TIER_ID = len(TIER_LIMITS)
+
+# Prompt Configuration (built once at import, filled in per request)
+COMMENT_MODEL = "gpt-3.5-turbo"
+SYSTEM_MESSAGE = {"role": "system", "content": "You generate high-quality, professional LinkedIn comments based on user-defined personas and languages."}
+PROMPT_TEMPLATE = (
+    "You are a professional assistant for generating LinkedIn comments. "
+    "The user's desired persona is '{persona}'. "
+    "The comment must be in '{language}'. {emoji_instruction}\n\n"
+    "Generate a thoughtful comment for the following LinkedIn post:\n\n"
+    "POST: \"{post}\""
+)
+EMOJI_INSTRUCTIONS = ("Do not use emojis.", "Include relevant emojis.")
+
+
+def comment_messages(persona, response_language, include_emojis, post_content):
+    """Builds the chat messages that ask for a comment on a single post."""
+    prompt = PROMPT_TEMPLATE.format(
+        persona=persona,
+        language=response_language,
+        emoji_instruction=EMOJI_INSTRUCTIONS[bool(include_emojis)],
+        post=post_content
+    )
+    return [SYSTEM_MESSAGE, {"role": "user", "content": prompt}]
+
+
+# Batch prompt: several posts in one request, answered as a JSON object
+BATCH_MAX_POSTS = 10
+BATCH_PROMPT_HEADER = (
+    "You are a professional assistant for generating LinkedIn comments. "
+    "Generate a thoughtful comment for each LinkedIn post below, following that post's persona, language and emoji instruction. "
+    "Respond with a JSON object of the form {\"comments\": [\"...\"]} containing exactly one comment per post, in the same order.\n\n"
+)
+BATCH_POST_TEMPLATE = (
+    "{number}. Persona: '{persona}'. Language: '{language}'. {emoji_instruction}\n"
+    "POST: \"{post}\"\n\n"
+)
+
+
+# Successful password checks, keyed by (password_hash, HMAC of the password
+# under a per-process pepper), so repeat logins skip the slow PBKDF2 check.
+# Keying on the stored hash means a password change invalidates the entry.
+PASSWORD_CACHE_SIZE = 10_000
+_password_pepper = os.urandom(32)
+_verified_passwords = OrderedDict()
+_verified_passwords_lock = threading.Lock()
+
+
+def verify_password(password_hash, password):
+    """Checks a password against its stored hash, caching successful checks."""
+    if not password_hash:
+        return False
+
+    key = (password_hash, hmac.new(_password_pepper, password.encode(), hashlib.sha256).digest())
+    with _verified_passwords_lock:
+        if key in _verified_passwords:
+            _verified_passwords.move_to_end(key)
+            return True
+
+    if not check_password_hash(password_hash, password):
+        return False
+
+    with _verified_passwords_lock:
+        _verified_passwords[key] = True
+        if len(_verified_passwords) > PASSWORD_CACHE_SIZE:
+            _verified_passwords.popitem(last=False)
+    return True
+
+
+# Signed session tokens issued by /login. When SESSION_SECRET is set, every
+# generation request must send one as "Authorization: Bearer <token>" and the
+# user is taken from it; without a secret, requests identify the user by
+# userId as before. The token also carries the user's tier, which is trusted
+# for SESSION_TIER_MAX_AGE_SECONDS before the cached Firestore tier is used.
+SESSION_SECRET = os.environ.get("SESSION_SECRET")
+SESSION_TTL_SECONDS = 60 * 60
+SESSION_TIER_MAX_AGE_SECONDS = 5 * 60
+
+
+def issue_session_token(email, tier):
+    """Returns a signed session token for the user, or None if not configured."""
+    if not SESSION_SECRET:
+        return None
+    now = int(time.time())
+    claims = {"sub": email, "tier": tier, "iat": now, "exp": now + SESSION_TTL_SECONDS}
+    return jwt.encode(claims, SESSION_SECRET, algorithm="HS256")
+
+
+def request_session(body_user_id):
+    """Returns (user_id, tier_id) for the current request.
+
+    tier_id comes from a recently issued token and is None otherwise. Raises
+    jwt.InvalidTokenError when sessions are enabled and the token is missing,
+    forged or expired, or names a different user than `body_user_id`.
+    """
+    if not SESSION_SECRET:
+        return body_user_id, None
+
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        raise jwt.InvalidTokenError("missing session token")
+    claims = jwt.decode(
+        auth_header[len("Bearer "):], SESSION_SECRET,
+        algorithms=["HS256"], options={"require": ["sub", "iat", "exp"]}
+    )
+    if body_user_id and body_user_id != claims["sub"]:
+        raise jwt.InvalidTokenError("userId does not match the session")
+
+    tier_id = None
+    if time.time() - claims["iat"] < SESSION_TIER_MAX_AGE_SECONDS:
+        tier_id = TIER_IDS.get(claims.get("tier"))
+    return claims["sub"], tier_id
+
+
+# Today's UTC date as stored in 'last_comment_date'. A background greenlet
+# keeps it current so request handlers only read a global.
+TODAY_REFRESH_SECONDS = 30
+_today = [datetime.utcnow().strftime('%Y-%m-%d')]
+
+
+def _refresh_today_forever():
+    while True:
+        gevent.sleep(TODAY_REFRESH_SECONDS)
+        _today[0] = datetime.utcnow().strftime('%Y-%m-%d')
+
+
+gevent.spawn(_refresh_today_forever)
+
+
+# Per-worker cache of each user's quota fields, so /generate-comment doesn't
+# read Firestore on every call. Entries expire quickly because other workers
+# update the same counters.
+QUOTA_CACHE_SIZE = 50_000
+QUOTA_CACHE_TTL_SECONDS = 30
+_quota_cache = TTLCache(maxsize=QUOTA_CACHE_SIZE, ttl=QUOTA_CACHE_TTL_SECONDS)
+
+
+# Guards the cached quota state shared by concurrent requests
+_quota_lock = threading.Lock()
+
+
+def cache_quota_state(user_id, user_data):
+    """Merges the quota fields of a user document into the local cache.
+
+    An existing entry is updated in place and keeps the higher count for the
+    day, so comments still being generated and increments not yet flushed to
+    Firestore aren't forgotten when the document is re-read.
+    """
+    tier = user_data.get('subscription_tier', 'free')
+    count = user_data.get('daily_comment_count', 0)
+    date = user_data.get('last_comment_date')
+
+    with _quota_lock:
+        quota_state = _quota_cache.get(user_id)
+        if quota_state is None:
+            quota_state = {'daily_comment_count': count, 'last_comment_date': date}
+            _quota_cache[user_id] = quota_state
+        elif date == quota_state['last_comment_date']:
+            quota_state['daily_comment_count'] = max(quota_state['daily_comment_count'], count)
+        elif (date or '') > (quota_state['last_comment_date'] or ''):
+            quota_state['daily_comment_count'] = count
+            quota_state['last_comment_date'] = date
+
+        quota_state['subscription_tier'] = tier
+        quota_state['tier_id'] = TIER_IDS.get(tier, UNKNOWN_TIER_ID)
+    return quota_state
+
+
+def get_quota_state(user_id):
+    """Returns a user's quota fields, reading Firestore only on a cache miss."""
+    quota_state = _quota_cache.get(user_id)
+    if quota_state is not None:
+        return quota_state
+
+    user_doc = users_ref.document(user_id).get()
+    if not user_doc.exists:
+        return None
+    return cache_quota_state(user_id, user_doc.to_dict())
+
+
+def reserve_comment(quota_state, today_str, count=1, tier_id=None):
+    """Claims `count` comments from the user's daily quota if enough are left.
+
+    The limit comes from `tier_id` when given (e.g. from a session token),
+    otherwise from the cached tier.
+
+    Returns False when the limit would be exceeded. Claimed comments that end
+    up not being generated must be handed back with release_comment().
+
+    The check is atomic within this worker only. Each Gunicorn worker has its
+    own cache, so a burst spread across workers can exceed the limit until
+    the flushed counts are re-read (at most QUOTA_CACHE_TTL_SECONDS later).
+    """
+    with _quota_lock:
+        # Reset daily count if it's a new day
+        if quota_state.get('last_comment_date') != today_str:
+            quota_state['daily_comment_count'] = 0
+            quota_state['last_comment_date'] = today_str
+
+        if tier_id is None:
+            tier_id = quota_state['tier_id']
+        limit = TIER_LIMITS_BY_ID[tier_id]
+        if quota_state['daily_comment_count'] + count > limit:
+            return False
+        quota_state['daily_comment_count'] += count
+        return True
+
+
+def release_comment(quota_state, count=1):
+    """Returns comments claimed by reserve_comment() to the user's quota."""
+    with _quota_lock:
+        quota_state['daily_comment_count'] -= count
+
+
+# Usage increments waiting to be written, keyed by (user_id, date). A
+# background greenlet flushes them to Firestore in batched writes.
+QUOTA_FLUSH_INTERVAL_SECONDS = 0.5
+FIRESTORE_BATCH_LIMIT = 500
+QUOTA_FLUSH_MAX_RETRIES = 20
+_pending_comment_counts = Counter()
+# Failed per-user writes for each pending key, so bad documents are dropped
+# after QUOTA_FLUSH_MAX_RETRIES instead of being retried forever
+_comment_count_retries = Counter()
+_pending_comment_counts_lock = threading.Lock()
+
+
+def record_comment(user_id, today_str, count=1):
+    """Queues a usage increment for the next batched Firestore write."""
+    with _pending_comment_counts_lock:
+        _pending_comment_counts[(user_id, today_str)] += count
+
+
+def flush_comment_counts():
+    """Writes all queued usage increments to Firestore."""
+    with _pending_comment_counts_lock:
+        pending = list(_pending_comment_counts.items())
+        _pending_comment_counts.clear()
+
+    for start in range(0, len(pending), FIRESTORE_BATCH_LIMIT):
+        chunk = pending[start:start + FIRESTORE_BATCH_LIMIT]
+        batch = db.batch()
+        for (user_id, today_str), count in chunk:
+            batch.update(users_ref.document(user_id), comment_count_update(today_str, count))
+        try:
+            batch.commit()
+        except Exception as e:
+            # A batch fails as a whole (e.g. NOT_FOUND for one deleted user),
+            # so fall back to per-user writes to isolate the bad documents
+            print(f"Error flushing usage counts in a batch, writing users one by one: {e}")
+            for key, count in chunk:
+                _flush_comment_count(key, count)
+        else:
+            with _pending_comment_counts_lock:
+                for key, _ in chunk:
+                    _comment_count_retries.pop(key, None)
+
+
+def comment_count_update(today_str, count):
+    """Builds the Firestore update that adds `count` comments to a user."""
+    return {
+        'daily_comment_count': firestore.Increment(count),
+        'last_comment_date': today_str
+    }
+
+
+def _flush_comment_count(key, count):
+    """Writes one user's increment; requeues it on errors other than NOT_FOUND."""
+    user_id, today_str = key
+    try:
+        users_ref.document(user_id).update(comment_count_update(today_str, count))
+    except NotFound:
+        print(f"Dropping {count} usage count(s) for {key}: user document not found")
+    except Exception as e:
+        with _pending_comment_counts_lock:
+            attempts = _comment_count_retries[key] + 1
+            if attempts <= QUOTA_FLUSH_MAX_RETRIES:
+                _comment_count_retries[key] = attempts
+                _pending_comment_counts[key] += count
+        if attempts <= QUOTA_FLUSH_MAX_RETRIES:
+            print(f"Error flushing usage count for {key}, will retry: {e}")
+            return
+        print(f"Dropping {count} usage count(s) for {key} after {QUOTA_FLUSH_MAX_RETRIES} retries: {e}")
+
+    with _pending_comment_counts_lock:
+        _comment_count_retries.pop(key, None)
+
+
+def _flush_comment_counts_forever():
+    while True:
+        gevent.sleep(QUOTA_FLUSH_INTERVAL_SECONDS)
+        flush_comment_counts()
+
+
+if db:
+    gevent.spawn(_flush_comment_counts_forever)
+    atexit.register(flush_comment_counts)
+
+
+# Generated comments keyed by a hash of everything that goes into the prompt,
+# so identical requests skip the OpenAI round-trip.
+COMMENT_CACHE_SIZE = 10_000
+COMMENT_CACHE_TTL_SECONDS = 24 * 60 * 60
+_comment_cache = TTLCache(maxsize=COMMENT_CACHE_SIZE, ttl=COMMENT_CACHE_TTL_SECONDS)
+
+
+def comment_cache_key(persona, response_language, include_emojis, post_content):
+    """Builds the comment cache key, ignoring whitespace differences in the post."""
+    normalized_post = " ".join(str(post_content).split())
+    # A JSON array keeps field boundaries unambiguous whatever the values contain
+    raw_key = orjson.dumps([str(persona), str(response_language), bool(include_emojis), normalized_post])
+    return hashlib.sha256(raw_key).hexdigest()
+
+
+def sse_event(payload):
+    """Encodes a payload as one server-sent event."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+def stream_comment_events(user_id, quota_state, today_str, messages, cache_key, cached_text=None):
+    """Streams a comment as server-sent events as OpenAI produces it.
+
+    Emits {"delta": ...} events followed by {"done": true, "comment": ...}.
+    The comment only counts against the quota once it is complete; the slot
+    claimed by the caller is released if generation fails or the client
+    disconnects.
+    """
+    completed = False
+    try:
+        if cached_text is None:
+            deltas = []
+            for delta in stream_chat_completion(model=COMMENT_MODEL, messages=messages):
+                deltas.append(delta)
+                yield sse_event({"delta": delta})
+            generated_text = "".join(deltas).strip()
+            if cache_key:
+                _comment_cache[cache_key] = generated_text
+        else:
+            generated_text = cached_text
+
+        record_comment(user_id, today_str)
+        completed = True
+        yield sse_event({"done": True, "comment": generated_text})
+
+    except Exception as e:
+        print(f"An error occurred while streaming a comment: {e}")
+        yield sse_event({"error": "Failed to generate comment due to a server error."})
+
+    finally:
+        if not completed:
+            release_comment(quota_state)
+
 
 # --- USER AUTHENTICATION ENDPOINTS ---
 
@@ -75,10 +552,11 @@ def signup():
         'password_hash': password_hash,
         'subscription_tier': 'free', # Default to free tier
         'daily_comment_count': 0,
-        'last_comment_date': datetime.now().strftime('%Y-%m-%d'),
-        'created_at': datetime.now()
+        'last_comment_date': _today[0],
+        'created_at': datetime.utcnow()
     }
     users_ref.document(email).set(user_data)
+    cache_quota_state(email, user_data)
 
     return jsonify({"success": True, "message": "User created successfully"}), 201
 
@@ -102,14 +580,15 @@ def login():
 
     user_data = user_doc.to_dict()
 
-    if not check_password_hash(user_data.get('password_hash'), password):
+    if not verify_password(user_data.get('password_hash'), password):
         return jsonify({"error": "Invalid credentials"}), 401
-    
-    # NOTE: In a real production app, you would return a secure token (e.g., JWT)
-    # For simplicity here, we'll just confirm success and the client will store the email.
+
+    cache_quota_state(email, user_data)
+
     return jsonify({
         "success": True,
         "message": "Login successful",
+        "token": issue_session_token(email, user_data.get('subscription_tier', 'free')),
         "userData": {
             "email": user_data.get('email'),
             "tier": user_data.get('subscription_tier'),
@@ -119,7 +598,7 @@ def login():
     }), 200
 
 
-# --- CORE FUNCTIONALITY ENDPOINT ---
+# --- CORE FUNCTIONALITY ENDPOINTS ---
 
 @app.route("/generate-comment", methods=["POST"])
 def generate_comment():
@@ -128,7 +607,10 @@ def generate_comment():
         return jsonify({"error": "A backend service is not configured"}), 500
 
     data = request.json
-    user_id = data.get("userId") # User's email will be the ID
+    try:
+        user_id, session_tier_id = request_session(data.get("userId"))
+    except jwt.InvalidTokenError:
+        return jsonify({"error": "Invalid or expired session. Please log in again."}), 401
     post_content = data.get("postContent")
     persona = data.get("persona", "friendly and professional")
     response_language = data.get("responseLanguage", "English")
@@ -138,68 +620,410 @@ def generate_comment():
         return jsonify({"error": "Missing userId or postContent"}), 400
 
     # --- Usage Quota Logic ---
-    user_doc_ref = users_ref.document(user_id)
-    user_doc = user_doc_ref.get()
+    user_data = get_quota_state(user_id)
 
-    if not user_doc.exists:
+    if user_data is None:
         return jsonify({"error": "User not found. Please log in again."}), 404
 
-    user_data = user_doc.to_dict()
-    today_str = datetime.now().strftime('%Y-%m-%d')
-
-    # Reset daily count if it's a new day
-    if user_data.get('last_comment_date') != today_str:
-        user_data['daily_comment_count'] = 0
-        user_data['last_comment_date'] = today_str
-
-    # Check if user is over their limit
-    tier = user_data.get('subscription_tier', 'free')
-    limit = TIER_LIMITS.get(tier, 0)
+    today_str = _today[0]
+    tier_id = user_data['tier_id'] if session_tier_id is None else session_tier_id
+    limit = TIER_LIMITS_BY_ID[tier_id]
 
-    if user_data['daily_comment_count'] >= limit:
+    # Check the limit and claim a slot in one step, so concurrent requests from
+    # the same user on this worker can't both pass the check (other workers
+    # only see the claim once it is flushed and their cache entry expires)
+    if not reserve_comment(user_data, today_str, tier_id=tier_id):
         return jsonify({"error": f"Daily limit of {limit} comments reached. Please upgrade your plan."}), 429 # 429: Too Many Requests
 
     # --- OpenAI Comment Generation ---
     try:
-        emoji_instruction = "Include relevant emojis." if include_emojis else "Do not use emojis."
-        prompt = (
-            f"You are a professional assistant for generating LinkedIn comments. "
-            f"The user's desired persona is '{persona}'. "
-            f"The comment must be in '{response_language}'. {emoji_instruction}\n\n"
-            f"Generate a thoughtful comment for the following LinkedIn post:\n\n"
-            f"POST: \"{post_content}\""
-        )
-        
-        completion = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You generate high-quality, professional LinkedIn comments based on user-defined personas and languages."},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        generated_text = completion.choices[0].message.content.strip()
+        # Identical requests (e.g. several users on the same viral post) reuse
+        # an earlier comment. Enterprise users always get a fresh one.
+        cache_key = None
+        if tier_id != TIER_IDS['enterprise']:
+            cache_key = comment_cache_key(persona, response_language, include_emojis, post_content)
+        generated_text = _comment_cache.get(cache_key) if cache_key else None
 
-        # --- Update Usage Count in Firestore ---
-        user_doc_ref.update({
-            'daily_comment_count': firestore.Increment(1),
-            'last_comment_date': today_str
-        })
+        # Streaming is opt-in: tokens are sent as server-sent events as they
+        # arrive instead of one JSON response at the end
+        if data.get("stream"):
+            events = stream_comment_events(
+                user_id, user_data, today_str,
+                comment_messages(persona, response_language, include_emojis, post_content),
+                cache_key, cached_text=generated_text
+            )
+            return Response(events, mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+        if generated_text is None:
+            completion = create_chat_completion(
+                model=COMMENT_MODEL,
+                messages=comment_messages(persona, response_language, include_emojis, post_content)
+            )
+            generated_text = completion.choices[0].message.content.strip()
+            if cache_key:
+                _comment_cache[cache_key] = generated_text
+
+        # --- Update Usage Count ---
+        # The slot was already claimed in the cache; the Firestore write is
+        # batched by the background flusher so the response doesn't wait on it.
+        record_comment(user_id, today_str)
 
         # Log the generation for history (optional)
         # db.collection("generation_logs").add({ ... })
 
         return jsonify({"success": True, "comment": generated_text})
 
+    except RateLimitError as e:
+        release_comment(user_data)
+        # The SDK has already retried, honoring OpenAI's Retry-After header.
+        print(f"OpenAI rate limit reached: {e}")
+        retry_after = e.response.headers.get("retry-after", "10")
+        return jsonify({"error": "The service is busy. Please try again shortly."}), 503, {"Retry-After": retry_after}
+
     except Exception as e:
+        release_comment(user_data)
         print(f"An error occurred during comment generation: {e}")
         return jsonify({"error": "Failed to generate comment due to a server error."}), 500
 
 
+@app.route("/generate-comments-batch", methods=["POST"])
+def generate_comments_batch():
+    """Generates comments for several posts with a single OpenAI request."""
+    if not db or not client:
+        return jsonify({"error": "A backend service is not configured"}), 500
+
+    data = request.json
+    try:
+        user_id, session_tier_id = request_session(data.get("userId"))
+    except jwt.InvalidTokenError:
+        return jsonify({"error": "Invalid or expired session. Please log in again."}), 401
+    posts = data.get("posts")
+    default_persona = data.get("persona", "friendly and professional")
+    default_language = data.get("responseLanguage", "English")
+    default_include_emojis = data.get("includeEmojis", False)
+
+    if not user_id or not posts or not isinstance(posts, list):
+        return jsonify({"error": "Missing userId or posts"}), 400
+    if len(posts) > BATCH_MAX_POSTS:
+        return jsonify({"error": f"At most {BATCH_MAX_POSTS} posts can be generated at once."}), 400
+    if not all(isinstance(post, dict) and post.get("postContent") for post in posts):
+        return jsonify({"error": "Every post needs postContent"}), 400
+
+    # --- Usage Quota Logic ---
+    user_data = get_quota_state(user_id)
+
+    if user_data is None:
+        return jsonify({"error": "User not found. Please log in again."}), 404
+
+    today_str = _today[0]
+    tier_id = user_data['tier_id'] if session_tier_id is None else session_tier_id
+    limit = TIER_LIMITS_BY_ID[tier_id]
+
+    if not reserve_comment(user_data, today_str, count=len(posts), tier_id=tier_id):
+        return jsonify({"error": f"Not enough comments left in your daily limit of {limit}. Please upgrade your plan."}), 429
+
+    # --- OpenAI Comment Generation ---
+    try:
+        prompt = BATCH_PROMPT_HEADER + "".join(
+            BATCH_POST_TEMPLATE.format(
+                number=number,
+                persona=post.get("persona", default_persona),
+                language=post.get("responseLanguage", default_language),
+                emoji_instruction=EMOJI_INSTRUCTIONS[bool(post.get("includeEmojis", default_include_emojis))],
+                post=post["postContent"]
+            )
+            for number, post in enumerate(posts, start=1)
+        )
+
+        completion = create_chat_completion(
+            model=COMMENT_MODEL,
+            messages=[SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+            response_format={"type": "json_object"}
+        )
+        comments = orjson.loads(completion.choices[0].message.content).get("comments")
+        if (not isinstance(comments, list) or len(comments) != len(posts)
+                or not all(isinstance(comment, str) for comment in comments)):
+            raise ValueError(f"expected {len(posts)} comment strings, got {comments!r}")
+
+        record_comment(user_id, today_str, count=len(posts))
+
+        return jsonify({"success": True, "comments": [comment.strip() for comment in comments]})
+
+    except RateLimitError as e:
+        release_comment(user_data, count=len(posts))
+        print(f"OpenAI rate limit reached: {e}")
+        retry_after = e.response.headers.get("retry-after", "10")
+        return jsonify({"error": "The service is busy. Please try again shortly."}), 503, {"Retry-After": retry_after}
+
+    except Exception as e:
+        release_comment(user_data, count=len(posts))
+        print(f"An error occurred during batch comment generation: {e}")
+        return jsonify({"error": "Failed to generate comments due to a server error."}), 500
+
+
+# --- ENTERPRISE BATCH JOBS (OpenAI Batch API) ---
+
+# Jobs run at OpenAI's half-price batch rate and finish within 24h. Job state
+# lives in users/{email}/comment_batches and results in
+# users/{email}/generated_content.
+ASYNC_BATCH_MAX_POSTS = 1000
+BATCH_POLL_INTERVAL_SECONDS = 60
+BATCH_POLL_MAX_FAILURES = 10
+BATCH_TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+def _batch_result_error(result):
+    """Extracts a readable error message from a failed Batch API result line."""
+    response = result.get('response') or {}
+    error = result.get('error') or (response.get('body') or {}).get('error') or {}
+    return error.get('message') or f"Request failed with status {response.get('status_code')}"
+
+
+def _parse_batch_result(line):
+    """Parses one Batch API result line into (post_index, comment, error).
+
+    Returns None for lines that can't be tied to a post. Lines whose response
+    can't be read, or has no text content (e.g. a content-filter refusal),
+    count as failed posts.
+    """
+    try:
+        result = orjson.loads(line)
+        post_index = int(result['custom_id'])
+    except (orjson.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        print(f"Skipping unreadable batch result line: {e}")
+        return None
+
+    response = result.get('response') or {}
+    if response.get('status_code') != 200:
+        return post_index, None, _batch_result_error(result)
+    try:
+        content = response['body']['choices'][0]['message']['content']
+    except (KeyError, IndexError, TypeError):
+        content = None
+    if not isinstance(content, str):
+        return post_index, None, "No comment was generated for this post"
+    return post_index, content.strip(), None
+
+
+def _store_batch_results(user_id, batch_id, file_id):
+    """Writes each result line of a batch output or error file to Firestore."""
+    results_ref = users_ref.document(user_id).collection('generated_content')
+    output = client.files.content(file_id).content
+    write_batch = db.batch()
+    pending_writes = 0
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        parsed = _parse_batch_result(line)
+        if parsed is None:
+            continue
+        post_index, comment, error = parsed
+        # Deterministic IDs keep repeated syncs from duplicating results
+        write_batch.set(results_ref.document(f"{batch_id}-{post_index}"), {
+            'batch_id': batch_id,
+            'post_index': post_index,
+            'comment': comment,
+            'error': error,
+            'created_at': datetime.utcnow()
+        })
+        pending_writes += 1
+        if pending_writes == FIRESTORE_BATCH_LIMIT:
+            write_batch.commit()
+            write_batch = db.batch()
+            pending_writes = 0
+    if pending_writes:
+        write_batch.commit()
+
+
+def sync_comment_batch(user_id, batch_id):
+    """Copies an OpenAI batch's status, and results once finished, to Firestore.
+
+    A finished batch is always marked with its terminal status, even if some
+    results couldn't be stored, so it isn't downloaded again on every sync.
+    Returns the fields written to the batch document.
+    """
+    batch_doc_ref = users_ref.document(user_id).collection('comment_batches').document(batch_id)
+    batch = client.batches.retrieve(batch_id)
+    batch_update = {'status': batch.status}
+
+    if batch.status in BATCH_TERMINAL_STATUSES:
+        errors = []
+        if batch.errors and batch.errors.data:
+            errors = [error.message for error in batch.errors.data]
+        # Expired and cancelled jobs can still have partial results
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            try:
+                _store_batch_results(user_id, batch_id, file_id)
+            except Exception as e:
+                print(f"Error storing results of comment batch {batch_id}: {e}")
+                errors.append("Some results could not be saved.")
+        if errors:
+            batch_update['errors'] = errors
+
+    batch_doc_ref.update(batch_update)
+    return batch_update
+
+
+def _poll_comment_batch(user_id, batch_id):
+    failures = 0
+    while failures < BATCH_POLL_MAX_FAILURES:
+        gevent.sleep(BATCH_POLL_INTERVAL_SECONDS)
+        try:
+            if sync_comment_batch(user_id, batch_id)['status'] in BATCH_TERMINAL_STATUSES:
+                return
+            failures = 0
+        except NotFound:
+            print(f"Stopped polling comment batch {batch_id}: batch document not found")
+            return
+        except Exception as e:
+            failures += 1
+            print(f"Error polling comment batch {batch_id} ({failures}/{BATCH_POLL_MAX_FAILURES}): {e}")
+    print(f"Gave up polling comment batch {batch_id}; the status endpoint will sync it on request")
+
+
+@app.route("/generate-comments-async", methods=["POST"])
+def generate_comments_async():
+    """Submits an enterprise user's posts to the OpenAI Batch API."""
+    if not db or not client:
+        return jsonify({"error": "A backend service is not configured"}), 500
+
+    data = request.json
+    try:
+        user_id, session_tier_id = request_session(data.get("userId"))
+    except jwt.InvalidTokenError:
+        return jsonify({"error": "Invalid or expired session. Please log in again."}), 401
+    posts = data.get("posts")
+    default_persona = data.get("persona", "friendly and professional")
+    default_language = data.get("responseLanguage", "English")
+    default_include_emojis = data.get("includeEmojis", False)
+
+    if not user_id or not posts or not isinstance(posts, list):
+        return jsonify({"error": "Missing userId or posts"}), 400
+    if len(posts) > ASYNC_BATCH_MAX_POSTS:
+        return jsonify({"error": f"At most {ASYNC_BATCH_MAX_POSTS} posts can be submitted at once."}), 400
+    if not all(isinstance(post, dict) and post.get("postContent") for post in posts):
+        return jsonify({"error": "Every post needs postContent"}), 400
+
+    user_data = get_quota_state(user_id)
+
+    if user_data is None:
+        return jsonify({"error": "User not found. Please log in again."}), 404
+    tier_id = user_data['tier_id'] if session_tier_id is None else session_tier_id
+    if tier_id != TIER_IDS['enterprise']:
+        return jsonify({"error": "Batch jobs are available on the enterprise plan."}), 403
+
+    try:
+        batch_input = b"\n".join(
+            orjson.dumps({
+                "custom_id": str(index),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": COMMENT_MODEL,
+                    "messages": comment_messages(
+                        post.get("persona", default_persona),
+                        post.get("responseLanguage", default_language),
+                        post.get("includeEmojis", default_include_emojis),
+                        post["postContent"]
+                    )
+                }
+            })
+            for index, post in enumerate(posts)
+        )
+        input_file = client.files.create(file=("comments.jsonl", batch_input), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+
+        users_ref.document(user_id).collection('comment_batches').document(batch.id).set({
+            'status': batch.status,
+            'post_count': len(posts),
+            'created_at': datetime.utcnow()
+        })
+        gevent.spawn(_poll_comment_batch, user_id, batch.id)
+
+        return jsonify({"success": True, "batchId": batch.id, "status": batch.status}), 202
+
+    except Exception as e:
+        print(f"An error occurred while submitting a comment batch: {e}")
+        return jsonify({"error": "Failed to submit batch due to a server error."}), 500
+
+
+@app.route("/generate-comments-async/<batch_id>", methods=["GET"])
+def comment_batch_status(batch_id):
+    """Reports a batch job's status and, once finished, its comments.
+
+    `comments` has one entry per submitted post, in order, with null for posts
+    that failed or haven't finished; `failedPosts` explains the failures.
+    """
+    if not db or not client:
+        return jsonify({"error": "A backend service is not configured"}), 500
+
+    try:
+        user_id, _ = request_session(request.args.get("userId"))
+    except jwt.InvalidTokenError:
+        return jsonify({"error": "Invalid or expired session. Please log in again."}), 401
+    if not user_id:
+        return jsonify({"error": "Missing userId"}), 400
+
+    batch_doc = users_ref.document(user_id).collection('comment_batches').document(batch_id).get()
+    if not batch_doc.exists:
+        return jsonify({"error": "Batch not found"}), 404
+
+    try:
+        batch_data = batch_doc.to_dict()
+        # Refresh here too, in case the worker that was polling has restarted
+        if batch_data.get('status') not in BATCH_TERMINAL_STATUSES:
+            batch_data.update(sync_comment_batch(user_id, batch_id))
+        status = batch_data.get('status')
+
+        comments = [None] * batch_data.get('post_count', 0)
+        failed_posts = []
+        if status in BATCH_TERMINAL_STATUSES:
+            results = users_ref.document(user_id).collection('generated_content').where('batch_id', '==', batch_id).stream()
+            for result in results:
+                result = result.to_dict()
+                if not 0 <= result.get('post_index', -1) < len(comments):
+                    continue
+                if result.get('comment') is None:
+                    failed_posts.append({"postIndex": result['post_index'], "error": result.get('error')})
+                else:
+                    comments[result['post_index']] = result['comment']
+            failed_posts.sort(key=lambda failure: failure['postIndex'])
+
+        return jsonify({
+            "success": True,
+            "batchId": batch_id,
+            "status": status,
+            "comments": comments,
+            "failedPosts": failed_posts,
+            "errors": batch_data.get('errors', [])
+        })
+
+    except Exception as e:
+        print(f"An error occurred while checking comment batch {batch_id}: {e}")
+        return jsonify({"error": "Failed to check batch due to a server error."}), 500
+
+
 # --- HEALTH CHECK ---
-@app.route("/")
-def health_check():
-    """Health check endpoint for Render."""
-    return "OK"
+HEALTH_CHECK_HEADERS = [('Content-Type', 'text/plain'), ('Content-Length', '2')]
+
+
+def with_health_check(wsgi_app):
+    """Answers Render's health checks on / before Flask builds a request."""
+    def health_check(environ, start_response):
+        if environ.get('PATH_INFO') == '/' and environ.get('REQUEST_METHOD') in ('GET', 'HEAD'):
+            start_response('200 OK', HEALTH_CHECK_HEADERS)
+            return [] if environ['REQUEST_METHOD'] == 'HEAD' else [b'OK']
+        return wsgi_app(environ, start_response)
+    return health_check
+
+
+app.wsgi_app = with_health_check(app.wsgi_app)
 
 if __name__ == "__main__":
     # Use Gunicorn for production, this is for local dev only
@@ -0,0 +1,15 @@
+# gunicorn.conf.py
+# Picked up automatically by `gunicorn app:app` from the working directory.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# Every request is I/O-bound (Firestore + OpenAI), so each worker multiplexes
+# many in-flight requests on greenlets instead of blocking on one round-trip.
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+# OpenAI completions can take several seconds; don't kill busy workers.
+timeout = 120